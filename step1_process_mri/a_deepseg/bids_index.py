@@ -0,0 +1,174 @@
+"""
+A persistent index of the MRI sequences within a BIDS dataset, used by `iterative_sct.py` to avoid re-walking the
+(potentially network-mounted) dataset every time it is run.
+
+For each directory walked, the index stores its modification time alongside its contents; as adding, removing, or
+renaming anything within a directory updates its modification time, only directories which changed since the last
+refresh need to be listed again. For each sequence, the index stores its size, modification time, and BIDS entities,
+allowing sequences to be filtered by entity (i.e. contrast or orientation) without re-parsing their filenames, and to
+dispatch only those which are new (or changed) since they were last processed by a given script.
+
+Note that sequences overwritten in-place (rather than replaced) do not update their directory's modification time;
+rebuild the index from scratch if this has happened. Multiple scripts can share the same index; saves are serialized
+with a lock file, and each only updates the dispatch records of its own script.
+"""
+import fcntl
+import json
+import os
+from pathlib import Path
+
+
+# Incremented whenever the index's layout changes, invalidating older indices
+INDEX_VERSION = 2
+
+# The BIDS folder (and extension) MRI sequences are expected to be found within
+SEQUENCE_FOLDER = "anat"
+SEQUENCE_EXT = ".nii.gz"
+
+
+def parse_bids_name(fname: str):
+    """
+    Parses the BIDS entities (i.e. 'sub', 'ses', 'acq', 'run') and suffix (i.e. 'T2w') from a filename
+    """
+    stem = fname.split('.')[0]
+    components = stem.split('_')
+    entities = dict(c.split('-', 1) for c in components[:-1] if '-' in c)
+    entities["suffix"] = components[-1]
+    return stem, entities
+
+
+def new_index(root: Path):
+    return {"version": INDEX_VERSION, "root": str(root.resolve()), "dirs": {}, "files": {}, "dispatched": {}}
+
+
+def load_index(index_path: Path, root: Path):
+    """
+    Load an existing index, or create a new one if it does not exist (or was built for another dataset)
+    """
+    if not index_path.exists():
+        return new_index(root)
+    with open(index_path, 'r') as fp:
+        index = json.load(fp)
+    if index.get("version") != INDEX_VERSION or index.get("root") != str(root.resolve()):
+        return new_index(root)
+    return index
+
+
+def save_index(index: dict, index_path: Path, dispatch_key: str = None):
+    """
+    Save the index; as other scripts may have saved their own dispatch records to it since it was loaded, those are
+    re-read (under a lock) and kept, with only the records under our own dispatch key (if any) being updated
+    """
+    lock_path = index_path.with_name(index_path.name + ".lock")
+    with open(lock_path, 'w') as lock_fp:
+        fcntl.flock(lock_fp, fcntl.LOCK_EX)
+
+        dispatched = load_index(index_path, Path(index["root"]))["dispatched"]
+        if dispatch_key is not None:
+            dispatched[dispatch_key] = {**dispatched.get(dispatch_key, {}), **index["dispatched"].get(dispatch_key, {})}
+        index["dispatched"] = dispatched
+
+        # Write to a temporary file first, so an interrupted save can't corrupt the existing index
+        tmp_path = index_path.with_name(index_path.name + ".tmp")
+        with open(tmp_path, 'w') as fp:
+            json.dump(index, fp)
+        os.replace(tmp_path, index_path)
+
+
+def _scan_dir(dir_path: Path, rel_path: str, index: dict, new_dirs: dict, new_files: dict, exclude_dirs: set[str]):
+    dir_mtime = os.stat(dir_path).st_mtime_ns
+    dir_entry = index["dirs"].get(rel_path)
+
+    if dir_entry is not None and dir_entry["mtime"] == dir_mtime:
+        # Nothing was added or removed; re-use the prior listing (and the prior file attributes) as-is
+        for f in dir_entry["files"]:
+            f_rel = f"{rel_path}/{f}"
+            new_files[f_rel] = index["files"][f_rel]
+    else:
+        # Otherwise, list the directory's contents again
+        subdirs, files = [], []
+        with os.scandir(dir_path) as dir_iter:
+            for e in dir_iter:
+                # All subdirectories are listed, so that changing the excluded directories takes effect immediately
+                if e.is_dir():
+                    subdirs.append(e.name)
+                elif dir_path.name == SEQUENCE_FOLDER and e.name.endswith(SEQUENCE_EXT):
+                    files.append(e.name)
+                    # Sequences get their attributes (re-)tracked as well
+                    f_stat = e.stat()
+                    stem, entities = parse_bids_name(e.name)
+                    new_files[f"{rel_path}/{e.name}"] = {
+                        "size": f_stat.st_size,
+                        "mtime": f_stat.st_mtime_ns,
+                        "stem": stem,
+                        "subject": stem.split('_')[0],
+                        "entities": entities
+                    }
+        dir_entry = {"mtime": dir_mtime, "subdirs": sorted(subdirs), "files": sorted(files)}
+
+    new_dirs[rel_path] = dir_entry
+
+    # Check each subdirectory as well; those which are unchanged only need a `stat` call
+    for d in dir_entry["subdirs"]:
+        if d in exclude_dirs:
+            continue
+        _scan_dir(dir_path / d, f"{rel_path}/{d}", index, new_dirs, new_files, exclude_dirs)
+
+
+def refresh_index(index: dict, exclude_dirs: set[str]):
+    """
+    Update the index in-place to reflect the current contents of its dataset, re-listing only changed directories
+    """
+    root = Path(index["root"])
+    new_dirs, new_files = {}, {}
+    _scan_dir(root, ".", index, new_dirs, new_files, exclude_dirs)
+    index["dirs"] = new_dirs
+    index["files"] = new_files
+
+    # Sequences which no longer exist can't have been dispatched
+    for dispatched in index["dispatched"].values():
+        for f in [f for f in dispatched.keys() if f not in new_files]:
+            dispatched.pop(f)
+
+    return index
+
+
+def parse_filters(filter_args: list[str]):
+    """
+    Parses 'entity=value[,value...]' filters (i.e. 'acq=ax' or 'suffix=T1w,T2w') into a dictionary
+    """
+    filters = {}
+    for f in filter_args:
+        if '=' not in f:
+            raise ValueError(f"Invalid filter '{f}'; filters must be in the format 'entity=value'")
+        k, v = f.split('=', 1)
+        filters[k] = set(v.split(','))
+    return filters
+
+
+def matches_filters(entities: dict, filters: dict[str, set[str]]):
+    return all(entities.get(k) in v for k, v in filters.items())
+
+
+def select_sequences(index: dict, filters: dict[str, set[str]], dispatch_key: str = None):
+    """
+    Select the sequences within the index which match the filters; if a dispatch key is provided, only sequences
+    which are new (or have changed) since they were last dispatched under that key are selected.
+    """
+    root = Path(index["root"])
+    dispatched = index["dispatched"].get(dispatch_key, {})
+    selected = {}
+    for f_rel, f_entry in index["files"].items():
+        if not matches_filters(f_entry["entities"], filters):
+            continue
+        if dispatch_key is not None and dispatched.get(f_rel) == [f_entry["size"], f_entry["mtime"]]:
+            continue
+        selected[f_rel] = (root / f_rel, f_entry)
+    return selected
+
+
+def mark_dispatched(index: dict, dispatch_key: str, f_rels: list[str]):
+    dispatched = index["dispatched"].setdefault(dispatch_key, {})
+    for f_rel in f_rels:
+        f_entry = index["files"][f_rel]
+        dispatched[f_rel] = [f_entry["size"], f_entry["mtime"]]
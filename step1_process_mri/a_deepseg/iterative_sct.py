@@ -6,6 +6,9 @@ However, this script differs in a few key ways required to our analysis:
     * The script handles output management (we generate output folders in a hierarchical manner for ease of management)
 """
 import multiprocessing as mp
+import os
+import random
+import shutil
 import subprocess
 import timeit
 
@@ -13,6 +16,12 @@ from argparse import ArgumentParser
 from itertools import repeat
 from pathlib import Path
 
+from bids_index import load_index, mark_dispatched, matches_filters, parse_bids_name, parse_filters, refresh_index, \
+    save_index, select_sequences
+from seg_qc import DEFAULT_CRITERIA, cache_dir_for, run_qc
+from stage_resources import QC_STAGE, default_stage, init_worker, load_stage_config, parse_benchmark_settings, \
+    stage_env
+
 
 def valid_path(arg: str):
     """
@@ -27,24 +36,147 @@ def valid_path(arg: str):
     return p
 
 
-def run_script(script_path: Path, mri_file: Path, out_path: Path, sct_path: Path, log_name: str):
-    # Interpret the file name to extract needed parameters
-    fname = mri_file.name.split('.')[0]
-    subject = fname.split('_')[0]
+def get_dest_path(out_path: Path, subject: str, stem: str):
+    # Outputs are placed hierarchically; first by subject, then by the MRI sequence
+    return out_path / subject / stem
+
 
+def run_script(script_path: Path, mri_file: Path, dest_path: Path, sct_path: Path, log_name: str,
+               env: dict = None, reset_log: bool = True):
     # Generate the directory the output will be placed within
-    dest_path = out_path / subject
-    dest_path /= fname
     dest_path.mkdir(exist_ok=True, parents=True)
 
-    # (Re)Generate a logging file to track this thread's progress
+    # (Re)Generate a logging file to track this thread's progress; later stages append to it instead
     log_file = dest_path / log_name
-    if log_file.exists():
+    if reset_log and log_file.exists():
         log_file.unlink()
     log_file.touch()
 
-    # Run the script
-    subprocess.run(f"{script_path} {mri_file} {dest_path} {sct_path} >> {log_file} 2>&1", shell=True)
+    # Run the script, with any stage-specific environment variables layered on top of our own
+    run_env = {**os.environ, **env} if env else None
+    result = subprocess.run(
+        f"{script_path} {mri_file} {dest_path} {sct_path} >> {log_file} 2>&1", shell=True, env=run_env
+    )
+    return result.returncode
+
+
+def run_stages(stages: list[dict], pin_cpus: bool, script_path: Path, mri_files: list[Path], dest_paths: list[Path],
+               sct_path: Path, log_name: str, cache_dir: Path):
+    """
+    Run each stage of the script on every file in turn, each with its own worker count and thread budget. Files
+    which fail a stage are not run through the stages after it. The QC stage caches decompressed images in
+    `cache_dir`, unless it specifies a `cache_dir` of its own.
+    :return: Whether each file succeeded in every stage
+    """
+    # Pinning sizes each worker's block of cores by its thread budget; without one, it would silently do nothing
+    if pin_cpus:
+        unbudgeted = [s["name"] or "all" for s in stages if s["name"] != QC_STAGE and s.get("threads") is None]
+        if len(unbudgeted) > 0:
+            raise ValueError(f"Pinning CPUs requires a thread budget, but stage(s) {unbudgeted} have none; set "
+                             f"'--task_threads', or give each stage in the stage configuration its own 'threads'")
+
+    succeeded = [True] * len(mri_files)
+    for i, stage in enumerate(stages):
+        todo = [j for j, ok in enumerate(succeeded) if ok]
+        print(f"Running stage '{stage['name'] or 'all'}' on {len(todo)} files with {stage['workers']} workers "
+              f"({stage.get('threads') or 'unlimited'} threads each)")
+
+        # QC is run here directly; failing files are flagged, and not scheduled for the (expensive) metric stage
+        if stage["name"] == QC_STAGE:
+            seg_files = [dest_paths[j] / f"{dest_paths[j].name}_deepseg.nii.gz" for j in todo]
+            criteria = {k: v for k, v in stage.items() if k in DEFAULT_CRITERIA.keys()}
+            qc_cache = Path(stage["cache_dir"]) if stage.get("cache_dir") else cache_dir
+            qc_df = run_qc(seg_files, stage["workers"], qc_cache, criteria)
+            for j, passed in zip(todo, qc_df["passed"]):
+                succeeded[j] = bool(passed)
+            print(f"{(~qc_df['passed']).sum()} of {len(todo)} files failed QC")
+            continue
+
+        # Each stage gets its own pool, so workers can be (re-)pinned to match the stage's thread budget
+        slot_counter = mp.Value('i', 0)
+        init_args = (slot_counter, stage.get("threads"), pin_cpus)
+        with mp.Pool(stage["workers"], initializer=init_worker, initargs=init_args) as p:
+            return_codes = p.starmap(run_script, zip(
+                repeat(script_path),
+                [mri_files[j] for j in todo],
+                [dest_paths[j] for j in todo],
+                repeat(sct_path),
+                repeat(log_name),
+                repeat(stage_env(stage)),
+                repeat(i == 0)
+            ))
+
+        for j, rc in zip(todo, return_codes):
+            succeeded[j] = rc == 0
+
+    return succeeded
+
+
+def run_benchmark(settings: list[tuple[int, int]], n_samples: int, stages: list[dict], pin_cpus: bool,
+                  script_path: Path, sequences: dict, out_path: Path, sct_path: Path, log_name: str,
+                  expected_output: str = None):
+    """
+    Time the script on a sample of the files for each worker x thread setting, to find the best one for this node.
+    Settings are only compared if they processed as many files successfully as the best of them did, as a setting
+    which fails (i.e. by running out of memory) is often faster for it.
+    """
+    sample_keys = random.Random(0).sample(sorted(sequences.keys()), min(n_samples, len(sequences)))
+    mri_files = [sequences[k][0] for k in sample_keys]
+    if len(mri_files) < 1:
+        raise ValueError("No MRI sequences were found to benchmark with!")
+
+    bench_path = out_path / "benchmark"
+    results = []
+    for workers, threads in settings:
+        # Each setting starts from scratch, as the scripts skip anything which already exists
+        setting_path = bench_path / f"w{workers}_t{threads}"
+        if setting_path.exists():
+            shutil.rmtree(setting_path)
+        dest_paths = [get_dest_path(setting_path, sequences[k][1]["subject"], sequences[k][1]["stem"])
+                      for k in sample_keys]
+
+        bench_stages = [{**s, "workers": workers, "threads": threads} for s in stages]
+        bench_start = timeit.default_timer()
+        succeeded = run_stages(
+            bench_stages, pin_cpus, script_path, mri_files, dest_paths, sct_path, log_name, cache_dir_for(setting_path)
+        )
+        elapsed = timeit.default_timer() - bench_start
+
+        # The script's final output is a more reliable sign of success than its exit code, if we know what it is
+        if expected_output is not None:
+            succeeded = [(d / expected_output).exists() for d in dest_paths]
+        n_succeeded = sum(succeeded)
+        per_success = elapsed / n_succeeded if n_succeeded > 0 else float('inf')
+
+        results.append((workers, threads, n_succeeded, elapsed, per_success))
+        print(f"{workers} workers x {threads} threads: {n_succeeded} of {len(mri_files)} files succeeded in "
+              f"{elapsed:.1f} seconds ({per_success:.1f} per successful file)")
+
+    # Save the results for later comparison
+    with open(bench_path / "benchmark.tsv", 'w') as fp:
+        fp.write("workers\tthreads\tsucceeded\tseconds\tseconds_per_success\n")
+        for r in results:
+            fp.write("\t".join(str(x) for x in r) + "\n")
+
+    # Only settings which succeeded as often as the best one did are eligible
+    max_succeeded = max(r[2] for r in results)
+    if max_succeeded < 1:
+        print("No setting processed any of the files successfully; check the logs in the 'benchmark' folder")
+        return
+    best = min((r for r in results if r[2] == max_succeeded), key=lambda r: r[4])
+    print(f"Fastest setting: {best[0]} workers x {best[1]} threads ({best[2]} of {len(mri_files)} files succeeded)")
+
+
+def find_sequences(input_path: Path, filters: dict[str, set[str]]):
+    """
+    Walks the input directory for MRI sequences; used when no index is available
+    """
+    sequences = {}
+    for mri_file in input_path.rglob("anat/*.nii.gz"):
+        stem, entities = parse_bids_name(mri_file.name)
+        if matches_filters(entities, filters):
+            sequences[str(mri_file)] = (mri_file, {"stem": stem, "subject": stem.split('_')[0]})
+    return sequences
 
 
 def build_parser():
@@ -67,7 +199,34 @@ def build_parser():
     )
     parser.add_argument(
         '-t', '--threads', type=int, default=1,
-        help="Number of threads to use in this process."
+        help="Number of threads to use in this process (the number of files processed in parallel). Ignored if a "
+             "stage configuration is provided."
+    )
+    parser.add_argument(
+        '--task_threads', type=int, default=None,
+        help="The number of threads each file's processing may use (via OMP_NUM_THREADS and similar). If not "
+             "specified, SCT's tools will use as many threads as they like. Ignored if a stage configuration is "
+             "provided."
+    )
+    parser.add_argument(
+        '-c', '--stage_config', type=valid_path, default=None,
+        help="A JSON file specifying the stages to run the script in, each with its own number of workers and "
+             "threads per worker; see 'stage_config.json' for an example. If not provided, all stages are run at "
+             "once."
+    )
+    parser.add_argument(
+        '--pin_cpus', action='store_true',
+        help="Pin each worker to its own block of cores (sized by its thread budget), to avoid thread migration. "
+             "Requires a thread budget for every stage; see '--task_threads'."
+    )
+    parser.add_argument(
+        '--benchmark', nargs='+', default=None,
+        help="Instead of processing the files, time the script on a sample of them for each 'WORKERSxTHREADS' "
+             "setting provided (i.e. '1x16 2x8 4x4'). Results are placed in a 'benchmark' folder in the output."
+    )
+    parser.add_argument(
+        '--benchmark_samples', type=int, default=8,
+        help="The number of files to sample for benchmarking."
     )
     parser.add_argument(
         '-sct', '--sct_path', type=valid_path, required=True,
@@ -78,6 +237,38 @@ def build_parser():
         '-l', '--log_file', type=str, required=True,
         help="The name of the log file that will be generated for each file. Include the extension you want!"
     )
+    parser.add_argument(
+        '-f', '--filter', action='append', default=[],
+        help="Only process MRI sequences with the given BIDS entity, in the format 'entity=value[,value...]' (i.e. "
+             "'acq=ax', 'run=1', or 'suffix=T1w,T2w' for the contrast). Can be specified multiple times."
+    )
+    parser.add_argument(
+        '--index', type=Path, default=None,
+        help="A file to persist an index of the input directory's MRI sequences within, created if it doesn't "
+             "exist. Once built, only directories which changed since the last run are re-listed, rather than "
+             "walking the entire input directory again."
+    )
+    parser.add_argument(
+        '--reindex', action='store_true',
+        help="Rebuild the index from scratch, rather than refreshing it incrementally. Needed if an MRI sequence was "
+             "overwritten in-place."
+    )
+    parser.add_argument(
+        '--exclude_dirs', nargs='*', default=['derivatives'],
+        help="Names of directories which should not be indexed (and their contents). Only used with '--index'."
+    )
+    parser.add_argument(
+        '--only_changed', action='store_true',
+        help="Only process MRI sequences which are new (or changed) since this script last processed them "
+             "successfully. Requires '--index' and '--expected_output'."
+    )
+    parser.add_argument(
+        '--expected_output', type=str, default=None,
+        help="The name of the file the script places in each output folder once it has fully succeeded (i.e. "
+             "'deepseg_pam50_metrics.csv'). With '--only_changed', sequences are only considered processed if it "
+             "exists, as the scripts can exit successfully despite failing partway through; benchmarks also use it "
+             "to count successes, if provided."
+    )
 
     return parser
 
@@ -90,15 +281,60 @@ if __name__ == "__main__":
     # Begin timing
     start = timeit.default_timer()
 
-    # Process the files, in parallel if multiple threads are available
-    with mp.Pool(argvs.threads) as p:
-        p.starmap(run_script, zip(
-            repeat(argvs.script),
-            argvs.input.rglob("anat/*.nii.gz"),
-            repeat(argvs.output),
-            repeat(argvs.sct_path),
-            repeat(argvs.log_file)
-        ))
+    if argvs.only_changed and argvs.expected_output is None:
+        raise ValueError("'--only_changed' requires the script's final output; please specify it with "
+                         "'--expected_output'")
+
+    # Find the MRI sequences to process, using (and updating) the index if one was requested
+    filters = parse_filters(argvs.filter)
+    dispatch_key = None
+    if argvs.index is not None:
+        index = load_index(argvs.index, argvs.input)
+        if argvs.reindex:
+            index["dirs"], index["files"] = {}, {}
+        index = refresh_index(index, set(argvs.exclude_dirs))
+        # Track what has already been processed separately for each script
+        if argvs.only_changed:
+            dispatch_key = f"{argvs.script.resolve()}:{argvs.log_file}"
+        sequences = select_sequences(index, filters, dispatch_key)
+    elif argvs.only_changed:
+        raise ValueError("'--only_changed' requires an index; please specify one with '--index'")
+    else:
+        sequences = find_sequences(argvs.input, filters)
+    print(f"Found {len(sequences)} MRI sequences to process")
+
+    # Determine the stages to run the script in, and the resources given to each
+    if argvs.stage_config is not None:
+        stage_config = load_stage_config(argvs.stage_config)
+        stages = stage_config["stages"]
+        pin_cpus = argvs.pin_cpus or stage_config.get("pin_cpus", False)
+    else:
+        stages = [default_stage(argvs.threads, argvs.task_threads)]
+        pin_cpus = argvs.pin_cpus
+
+    # If benchmarking was requested, do so instead of processing the files
+    if argvs.benchmark is not None:
+        run_benchmark(
+            parse_benchmark_settings(argvs.benchmark), argvs.benchmark_samples, stages, pin_cpus,
+            argvs.script, sequences, argvs.output, argvs.sct_path, argvs.log_file, argvs.expected_output
+        )
+    else:
+        mri_files = [v[0] for v in sequences.values()]
+        dest_paths = [get_dest_path(argvs.output, v[1]["subject"], v[1]["stem"]) for v in sequences.values()]
+
+        # Process the files, in parallel if multiple threads are available
+        succeeded = run_stages(
+            stages, pin_cpus, argvs.script, mri_files, dest_paths, argvs.sct_path, argvs.log_file,
+            cache_dir_for(argvs.output)
+        )
+
+        # Save the updated index, noting which files were processed successfully (judged by their final output)
+        if argvs.index is not None:
+            if dispatch_key is not None:
+                mark_dispatched(index, dispatch_key, [
+                    k for k, d in zip(sequences.keys(), dest_paths) if (d / argvs.expected_output).exists()
+                ])
+            save_index(index, argvs.index, dispatch_key)
 
     # End timing
     end = timeit.default_timer()
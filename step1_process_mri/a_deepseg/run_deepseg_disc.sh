@@ -11,6 +11,12 @@ PER_VERT_OUT_NAME="deepseg_disc_metrics.csv"
 # Add the SCT utilities to the PATH
 export PATH="$PATH:$SCT_PATH"
 
+# Stages of this script to run (comma-separated); all of them, unless told otherwise (i.e. by iterative_sct.py)
+SCT_STAGES=${SCT_STAGES:-"seg,label,metrics"}
+function run_stage () {
+  [[ ",$SCT_STAGES," == *",$1,"* ]]
+}
+
 # Identify attributes of the file
 if [[ "$INPUT_FILE" == *"T1"* ]]; then
   CONTRAST="t1"
@@ -28,7 +34,9 @@ SEG_NAME="${SEG_NAME%%.*}_deepseg.nii.gz"
 SEG_FILE="$OUT_FOLDER/$SEG_NAME"
 
 # Run DeepSeg (contrast agnostic segmentation) on the file
-if [ ! -f "$SEG_FILE" ]; then
+if ! run_stage "seg"; then
+  echo "Segmentation stage not requested, skipping"
+elif [ ! -f "$SEG_FILE" ]; then
   sct_deepseg "spinalcord" -i "$INPUT_FILE" -o "$SEG_FILE"
 else
   printf "\n"
@@ -39,7 +47,9 @@ fi
 VERT_FILE="$OUT_FOLDER/${SEG_NAME%%.*}_labeled.nii.gz"
 
 # Identify the vertebrae within the segmentation
-if [ ! -f "$VERT_FILE" ]; then
+if ! run_stage "label"; then
+  echo "Vertebral labelling stage not requested, skipping"
+elif [ ! -f "$VERT_FILE" ]; then
   # Attempt to run vertebrae labelling
   echo "Attempting vertebral labelling!"
   bash "label_vertebrae.sh" "$INPUT_FILE" "$SEG_FILE" "$OUT_FOLDER" "$CONTRAST" "$SCT_PATH" "$VERT_FILE"
@@ -48,7 +58,7 @@ else
   echo "Vertebral labels already exist, skipping"
 fi
 
-if [ ! -f "$VERT_FILE" ]; then
+if [ ! -f "$VERT_FILE" ] && { run_stage "label" || run_stage "metrics"; }; then
   echo "No vertebral label found, terminating early"
   exit 1
 fi
@@ -58,7 +68,9 @@ DISC_POS_FILE="$OUT_FOLDER/${SEG_NAME%%.*}_labeled_discs.nii.gz"
 VERT_POS_FILE="$OUT_FOLDER/${SEG_NAME%%.*}_labeled_verts.nii.gz"
 
 # If the disc position annotations don't exist, generate them
-if [ ! -f "$VERT_POS_FILE" ]; then
+if ! run_stage "label"; then
+  echo "Disc offset stage not requested, skipping"
+elif [ ! -f "$VERT_POS_FILE" ]; then
   # Run the disc offset script
   conda activate DCM_Disk_ML
   python disc_to_vert_pos.py -i "$DISC_POS_FILE"
@@ -67,7 +79,7 @@ else
   echo "Disc offset annotations already exist, skipping."
 fi
 
-if [! -f "$VERT_POS_FILE" ]; then
+if [ ! -f "$VERT_POS_FILE" ] && { run_stage "label" || run_stage "metrics"; }; then
   echo "Failed to run disc-centering, terminating early"
   exit 1
 fi
@@ -77,7 +89,9 @@ TMP_DIR="$OUT_FOLDER/tmp"
 TMP_OUT="$TMP_DIR/${SEG_NAME%%.*}_labeled.nii.gz"
 DISC_OUT="$OUT_FOLDER/${SEG_NAME%%.*}_disc_centered_labeled.nii.gz"
 
-if [ ! -f "$DISC_OUT" ]; then
+if ! run_stage "label"; then
+  echo "Disc labelling stage not requested, skipping"
+elif [ ! -f "$DISC_OUT" ]; then
   echo "Attempting 'disc' labelling!"
   # Create a tmp directory to avoid overwrites
   if [ ! -d "$TMP_DIR" ]; then
@@ -101,7 +115,12 @@ fi
 PER_VERT_OUT_FILE="$OUT_FOLDER/$PER_VERT_OUT_NAME"
 
 # Use the disc labels alongside the segmentation to generate disc-centered "vertebral" metrics
-if [ ! -f "$PER_VERT_OUT_FILE" ]; then
+if ! run_stage "metrics"; then
+  echo "Metric stage not requested, skipping"
+elif [ -f "$OUT_FOLDER/FAILED_SEG_QC" ]; then
+  echo "Segmentation failed QC (see FAILED_SEG_QC), skipping metric generation"
+  exit 1
+elif [ ! -f "$PER_VERT_OUT_FILE" ]; then
   echo "Beginning segmentation processing"
   OLD_DIR=$PWD
   cd "$OUT_FOLDER" || echo "Could not enter output directory for some reason; perhaps it got deleted during runtime?"
@@ -0,0 +1,283 @@
+"""
+Fast quality control of the spinal cord segmentations (and vertebral labels) generated by the `run_` scripts.
+
+Bad segmentations otherwise only become apparent once their metrics have been generated (if they fail at all), so
+this runs a set of cheap checks on each one instead, flagging those which fail with a `FAILED_SEG_QC` file in their
+output folder (listing why); the `run_` scripts skip the metric stage for any flagged output. It can be run on its own
+after the labelling stage, or as the `qc` stage of a stage configuration for `iterative_sct.py`.
+
+As the same segmentation and label files are re-read often, each is decompressed once into a local cache and
+memory-mapped from there, rather than paying for gzip decompression on every read. Each output directory has its
+own cache (on the local disk), which persists between runs so unchanged images are never decompressed twice; it only
+keeps the latest copy of each image, so it grows no larger than the output directory's images do. Runs sharing a cache
+take turns, via a lock file next to it.
+"""
+import fcntl
+import gzip
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import zlib
+from argparse import ArgumentParser
+from hashlib import sha1
+from itertools import repeat
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+from nibabel.filebasedimages import ImageFileError
+from scipy import ndimage
+
+
+# Name of the file marking an output as having failed QC
+QC_MARKER = "FAILED_SEG_QC"
+
+# Default thresholds for each check. No vertebral levels are required by default, as scans whose field of view misses
+# some of the levels the metrics are generated for still produce valid metrics for the remainder
+DEFAULT_CRITERIA = {
+    "min_voxels": 500,
+    "min_slices": 10,
+    "min_coverage": 0.9,
+    "max_components": 1,
+    "min_component_voxels": 20,
+    "levels": []
+}
+
+# Errors raised when reading a truncated or otherwise corrupted image
+READ_ERRORS = (OSError, EOFError, ValueError, zlib.error, ImageFileError)
+
+# Local directory the caches of each output directory are placed within
+CACHE_ROOT = Path(tempfile.gettempdir()) / "dcm_seg_qc_cache"
+
+
+def get_parser():
+    argparser = ArgumentParser(
+        prog="Segmentation QC",
+        description="Runs fast quality control checks on all spinal cord segmentations within a directory."
+    )
+
+    argparser.add_argument(
+        '-r', '--root_dir', required=True, type=Path,
+        help="The output directory of `iterative_sct.py`; all segmentations (`*_deepseg.nii.gz`) within are checked."
+    )
+    argparser.add_argument(
+        '-o', '--output', default=Path('seg_qc.tsv'), type=Path,
+        help="The `.tsv` file the QC report, one row per segmentation, should be saved to."
+    )
+    argparser.add_argument(
+        '-t', '--threads', type=int, default=1,
+        help="Number of segmentations to check in parallel."
+    )
+    argparser.add_argument(
+        '--cache_dir', type=Path, default=None,
+        help="Local directory to place decompressed copies of the images in; should be on a local (fast) disk. By "
+             "default, each root directory gets its own cache within the system's temporary directory."
+    )
+    argparser.add_argument(
+        '--clear_cache', action='store_true',
+        help="Delete the cache directory (and everything in it) once QC is complete."
+    )
+    argparser.add_argument(
+        '--min_voxels', type=int, default=DEFAULT_CRITERIA["min_voxels"],
+        help="The minimum number of voxels a segmentation must contain."
+    )
+    argparser.add_argument(
+        '--min_slices', type=int, default=DEFAULT_CRITERIA["min_slices"],
+        help="The minimum number of axial slices the segmentation must be present in."
+    )
+    argparser.add_argument(
+        '--min_coverage', type=float, default=DEFAULT_CRITERIA["min_coverage"],
+        help="The minimum proportion of axial slices between the segmentation's top and bottom which contain it; "
+             "lower values denote gaps in the segmentation."
+    )
+    argparser.add_argument(
+        '--max_components', type=int, default=DEFAULT_CRITERIA["max_components"],
+        help="The maximum number of (non-trivial) connected components the segmentation may be split into."
+    )
+    argparser.add_argument(
+        '--min_component_voxels', type=int, default=DEFAULT_CRITERIA["min_component_voxels"],
+        help="Connected components smaller than this are considered trivial, and ignored."
+    )
+    argparser.add_argument(
+        '--levels', type=int, nargs='*', default=DEFAULT_CRITERIA["levels"],
+        help="The vertebral levels which must be present in the labelled segmentation (`*_deepseg_labeled.nii.gz`). "
+             "None are required by default."
+    )
+
+    return argparser
+
+
+def cache_dir_for(root_dir: Path):
+    # Keyed on the root directory, so re-runs over the same outputs share a cache
+    return CACHE_ROOT / sha1(str(root_dir.resolve()).encode()).hexdigest()[:16]
+
+
+def cached_file_for(nii_file: Path, cache_dir: Path):
+    # Key the cache on the file's identity, then its state, so changed files are decompressed again
+    f_stat = nii_file.stat()
+    path_key = sha1(str(nii_file.resolve()).encode()).hexdigest()
+    return cache_dir / f"{path_key}_{f_stat.st_size}_{f_stat.st_mtime_ns}.nii"
+
+
+def cached_volume(nii_file: Path, cache_dir: Path):
+    """
+    Load an image via a decompressed copy in the cache, memory-mapping its data rather than reading it into memory
+    """
+    cached_file = cached_file_for(nii_file, cache_dir)
+
+    if not cached_file.exists():
+        # Decompress to a temporary file first, so other workers never see a partially written copy
+        tmp_file = cached_file.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            with gzip.open(nii_file, 'rb') as f_in, open(tmp_file, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.replace(tmp_file, cached_file)
+        finally:
+            # Only left behind if decompression failed
+            tmp_file.unlink(missing_ok=True)
+
+        # Drop any outdated copies of the same file
+        path_key = cached_file.name.split("_")[0]
+        for f in cache_dir.glob(f"{path_key}_*.nii"):
+            if f != cached_file:
+                f.unlink(missing_ok=True)
+
+    img = nib.load(cached_file, mmap=True)
+    return np.asanyarray(img.dataobj), img.affine
+
+
+def labeled_file_for(seg_file: Path):
+    # Mirrors the naming used by the `run_` scripts
+    return seg_file.parent / seg_file.name.replace('.nii.gz', '_labeled.nii.gz')
+
+
+def qc_scan(seg_file: Path, cache_dir: Path, criteria: dict):
+    """
+    Run the QC checks on a single segmentation (and its vertebral labels), returning the results of each
+    """
+    # Segmentation can fail outright, leaving nothing to check
+    if not seg_file.exists():
+        return {"segmentation": str(seg_file), "passed": False, "failures": "no segmentation"}
+
+    # As can the scripts writing the images, leaving them truncated
+    try:
+        return check_scan(seg_file, cache_dir, criteria)
+    except READ_ERRORS as e:
+        return {"segmentation": str(seg_file), "passed": False, "failures": f"unreadable image ({e})"}
+
+
+def check_scan(seg_file: Path, cache_dir: Path, criteria: dict):
+    seg_data, affine = cached_volume(seg_file, cache_dir)
+    seg_mask = seg_data > 0.5
+
+    # Find the superior-inferior axis of the image, which the slice checks run along
+    si_axis = [i for i, c in enumerate(nib.aff2axcodes(affine)) if c in ('S', 'I')][0]
+    in_plane_axes = tuple(i for i in range(seg_mask.ndim) if i != si_axis)
+    slices_present = np.flatnonzero(seg_mask.any(axis=in_plane_axes))
+
+    n_voxels = int(seg_mask.sum())
+    n_slices = len(slices_present)
+    coverage = n_slices / (slices_present[-1] - slices_present[0] + 1) if n_slices > 0 else 0.0
+
+    # Count the connected components, ignoring any trivially small ones
+    component_map, _ = ndimage.label(seg_mask)
+    component_sizes = np.bincount(component_map.ravel())[1:]
+    n_components = int((component_sizes >= criteria["min_component_voxels"]).sum())
+
+    # Check which vertebral levels were labelled, if labelling was done
+    labeled_file = labeled_file_for(seg_file)
+    if labeled_file.exists():
+        label_data, _ = cached_volume(labeled_file, cache_dir)
+        levels_present = set(np.unique(np.rint(label_data[label_data > 0])).astype(int).tolist())
+    else:
+        levels_present = set()
+    missing_levels = sorted(set(criteria["levels"]) - levels_present)
+
+    # Determine which checks (if any) failed
+    failures = []
+    if n_voxels < criteria["min_voxels"]:
+        failures.append(f"only {n_voxels} voxels segmented (< {criteria['min_voxels']})")
+    if n_slices < criteria["min_slices"]:
+        failures.append(f"only present in {n_slices} slices (< {criteria['min_slices']})")
+    if coverage < criteria["min_coverage"]:
+        failures.append(f"slice coverage of {coverage:.2f} (< {criteria['min_coverage']})")
+    if n_components > criteria["max_components"]:
+        failures.append(f"split into {n_components} components (> {criteria['max_components']})")
+    if not labeled_file.exists():
+        failures.append("no vertebral labels")
+    elif len(missing_levels) > 0:
+        failures.append(f"missing vertebral levels {missing_levels}")
+
+    return {
+        "segmentation": str(seg_file),
+        "voxels": n_voxels,
+        "slices": n_slices,
+        "coverage": coverage,
+        "components": n_components,
+        "levels": " ".join(str(x) for x in sorted(levels_present)),
+        "passed": len(failures) < 1,
+        "failures": "; ".join(failures)
+    }
+
+
+def update_marker(seg_file: Path, qc_result: dict):
+    # Flag failed outputs (noting why), and un-flag those which have since been fixed
+    marker_file = seg_file.parent / QC_MARKER
+    if qc_result["passed"]:
+        if marker_file.exists():
+            marker_file.unlink()
+    else:
+        with open(marker_file, 'w') as fp:
+            fp.write(qc_result["failures"].replace("; ", "\n") + "\n")
+
+
+def run_qc(seg_files: list[Path], threads: int, cache_dir: Path, criteria: dict = None, clear_cache: bool = False):
+    """
+    Check every segmentation in parallel, flagging those which fail
+    :return: A dataframe containing the QC results of every segmentation
+    """
+    criteria = {**DEFAULT_CRITERIA, **(criteria or {})}
+    if not cache_dir.exists():
+        cache_dir.mkdir(parents=True)
+
+    # Other runs using the same cache wait for this one to finish, so none of them remove an image another is reading
+    lock_path = cache_dir.with_name(cache_dir.name + ".lock")
+    with open(lock_path, 'w') as lock_fp:
+        fcntl.flock(lock_fp, fcntl.LOCK_EX)
+
+        with mp.Pool(threads) as p:
+            qc_results = p.starmap(qc_scan, zip(seg_files, repeat(cache_dir), repeat(criteria)))
+
+        # The cache is kept for the next run, unless requested otherwise
+        if clear_cache:
+            shutil.rmtree(cache_dir)
+
+    for seg_file, qc_result in zip(seg_files, qc_results):
+        update_marker(seg_file, qc_result)
+
+    return pd.DataFrame(qc_results, columns=[
+        "segmentation", "voxels", "slices", "coverage", "components", "levels", "passed", "failures"
+    ])
+
+
+def main(root_dir: Path, output: Path, threads: int, cache_dir: Path, clear_cache: bool, **criteria):
+    seg_files = sorted(root_dir.rglob("*_deepseg.nii.gz"))
+    if len(seg_files) < 1:
+        raise ValueError(f"No segmentations were found within directory '{root_dir.resolve()}'!")
+
+    if cache_dir is None:
+        cache_dir = cache_dir_for(root_dir)
+    qc_df = run_qc(seg_files, threads, cache_dir, criteria, clear_cache)
+    qc_df.to_csv(output, sep='\t', index=False)
+
+    n_failed = (~qc_df["passed"]).sum()
+    print(f"{n_failed} of {qc_df.shape[0]} segmentations failed QC; see '{output}' for details")
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    argvs = parser.parse_args().__dict__
+
+    main(**argvs)
@@ -0,0 +1,96 @@
+"""
+Resource management for the stages of the `run_` scripts when run through `iterative_sct.py`.
+
+SCT's tools (especially `sct_deepseg`, via PyTorch) start as many threads as there are cores by default; running
+several of them in parallel therefore oversubscribes the node badly. Instead, each stage of a script (segmentation,
+labelling, and metric generation) can be given its own number of parallel workers, and each worker its own thread
+budget, enforced through the environment variables the underlying libraries respect. Workers can optionally be
+pinned to their own disjoint set of cores as well.
+"""
+import json
+import os
+from pathlib import Path
+
+
+# Stages the `run_` scripts are split into, in the order they must run; selected via the `SCT_STAGES` variable.
+# The "qc" stage is run by `seg_qc.py` directly, rather than by the scripts
+STAGES = ["seg", "label", "qc", "metrics"]
+QC_STAGE = "qc"
+
+# Environment variables limiting the threads used by OpenMP (and PyTorch), the BLAS libraries, and ITK
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"
+]
+
+
+def load_stage_config(config_path: Path):
+    """
+    Loads a stage configuration file, confirming the stages within are valid and in a valid order
+    """
+    with open(config_path, 'r') as fp:
+        stage_config = json.load(fp)
+
+    stage_names = [s["name"] for s in stage_config["stages"]]
+    for s in stage_names:
+        if s not in STAGES:
+            raise ValueError(f"Unknown stage '{s}' in '{config_path}'; valid stages are {STAGES}")
+    if stage_names != sorted(stage_names, key=STAGES.index):
+        raise ValueError(f"Stages in '{config_path}' must be run in the order {STAGES}")
+
+    return stage_config
+
+
+def default_stage(workers: int, threads: int = None):
+    # A single "stage" running every stage of the script at once
+    return {"name": None, "workers": workers, "threads": threads}
+
+
+def stage_env(stage: dict):
+    """
+    Build the environment variables to run a stage of the script with
+    """
+    env = {}
+    # Only run this stage of the script
+    if stage["name"] is not None:
+        env["SCT_STAGES"] = stage["name"]
+    # Limit the threads each worker starts, if a budget was set
+    if stage.get("threads") is not None:
+        env.update({k: str(stage["threads"]) for k in THREAD_ENV_VARS})
+    return env
+
+
+def init_worker(slot_counter, threads: int, pin_cpus: bool):
+    """
+    Pool initializer which pins each worker (and the processes it starts) to its own block of cores
+    """
+    if not pin_cpus or threads is None or not hasattr(os, "sched_setaffinity"):
+        return
+
+    # Claim the next free slot; each slot maps onto a distinct block of the available cores
+    with slot_counter.get_lock():
+        slot = slot_counter.value
+        slot_counter.value += 1
+
+    cores = sorted(os.sched_getaffinity(0))
+    first = (slot * threads) % len(cores)
+    block = {cores[(first + i) % len(cores)] for i in range(min(threads, len(cores)))}
+    os.sched_setaffinity(0, block)
+
+
+def parse_benchmark_settings(settings: list[str]):
+    """
+    Parses benchmark settings in the format 'WORKERSxTHREADS' (i.e. '4x4') into (workers, threads) pairs
+    """
+    parsed = []
+    for s in settings:
+        try:
+            workers, threads = (int(x) for x in s.lower().split('x'))
+        except ValueError:
+            raise ValueError(f"Invalid benchmark setting '{s}'; settings must be in the format 'WORKERSxTHREADS'")
+        parsed.append((workers, threads))
+    return parsed
@@ -0,0 +1,371 @@
+"""
+Computes a study's expensive (deferred) test metrics only for the trials selected as each replicate's optimum.
+
+Metrics like permutation importance re-evaluate the model once per feature, dominating trial time if calculated for
+every trial, despite only the optimum trial of each replicate ever being used in the results analysis. This is an
+optional alternative to running the study as-is, set up by a deferred configuration (see `deferred_config/`) which
+points to the study configuration and lists the test metrics to defer; MOOP never reads it, and the study
+configuration itself remains unchanged. It runs in three steps:
+
+* `study`: writes a copy of the study configuration with the deferred metrics removed (and parameter tracking
+  enabled), seeded copies of the model configurations, and a job list running every dataset and model combination
+  (via `run_job_list.sl`);
+* `prepare`: once those jobs are done, selects the optimum trial of each replicate, and writes configurations with
+  that trial's parameters pinned (and a job list) to re-run it with the deferred test metrics;
+* `merge`: once those jobs are done, adds the deferred metrics of each re-run to its optimum's own row, saving them
+  into a new results database in the same format as the study's own.
+
+For a re-run to rebuild its trial's model exactly, the model must be deterministic. Most are not: AdaBoost and random
+forests sample the data, logistic regression's `saga` solver shuffles it, and SVCs calibrate their probabilities with
+an internal cross-validation. The study is therefore run with a `random_state` pinned in each of these models'
+configurations, so their re-runs refit the same model. MOOP derives its replicate splits itself, so each re-run
+reproduces the optimum's split by running replicates `0` through the optimum's own (with one trial each); this assumes
+MOOP draws its replicate splits in order from the study's seed, regardless of the number of trials. As a check, the
+re-run's validation objective is recorded against the original trial's (the `rerun_objective_delta` column); they only
+differ if the split or model differs.
+"""
+import logging
+from argparse import ArgumentParser
+from copy import deepcopy
+from pathlib import Path
+from sqlite3 import connect
+
+import numpy as np
+import pandas as pd
+
+from study_utils import JOB_COLS, MINIMIZED_OBJECTIVES, build_job_list, load_json, read_results_tables, \
+    save_job_list, save_json
+
+
+# Extra columns of the re-run job list files, identifying the results table each job will write
+RERUN_COLS = ["rerun_table"]
+
+# Models (by their name in MOOP) which are stochastic, but can be made reproducible with a `random_state`
+SEEDED_MODELS = {"AdaBoostClassifier", "LogisticRegression", "RFC", "SVC"}
+# Models which are deterministic already
+DETERMINISTIC_MODELS = {"KNNC"}
+
+# The metric used to break ties when selecting the optima of a given metric; mirrors the analysis notebook
+OPTIMA_TIE_BREAKERS = {
+    "balanced_accuracy": "log_loss",
+    "log_loss": "balanced_accuracy"
+}
+
+# Placeholder for parameters which the trial did not use (i.e. the C of a penalty which was not selected)
+UNSET = object()
+
+
+def get_parser():
+    argparser = ArgumentParser(
+        prog="Deferred Metrics",
+        description="Computes a study's deferred test metrics for the optimum trial of each replicate only."
+    )
+
+    argparser.add_argument(
+        'mode', choices=['study', 'prepare', 'merge'],
+        help="Whether to prepare the (cheap) study jobs, prepare the re-run jobs for the optimum trials, or merge the "
+             "re-runs' results once they have been run."
+    )
+    argparser.add_argument(
+        '-c', '--deferred_config', required=True, type=Path,
+        help="The deferred configuration, specifying the study configuration and the test metrics to defer."
+    )
+    argparser.add_argument(
+        '-r', '--results_db', default=None, type=Path,
+        help="The results database of the (cheap) study. If not specified, the one written by its jobs is used."
+    )
+    argparser.add_argument(
+        '-m', '--model_folder', default='./model_configs', type=Path,
+        help="Folder containing the model configurations to run the study with. Seeded copies of them are placed in "
+             "the output folder, which the study (and the re-runs of its optima) use instead."
+    )
+    argparser.add_argument(
+        '-d', '--data_folder', default=[], type=Path, nargs='+',
+        help="Folder(s) containing the dataset configurations used in the study. Required when preparing jobs."
+    )
+    argparser.add_argument(
+        '--optima', default=None, nargs='+',
+        help="The validation metric(s) whose per-replicate optima should have their deferred metrics computed. "
+             "If not specified, the study's objective is used."
+    )
+    argparser.add_argument(
+        '-o', '--output_folder', default='./deferred', type=Path,
+        help="Folder where the generated configurations, job lists, and results are placed within."
+    )
+
+    return argparser
+
+
+def load_deferred_config(config_path: Path):
+    """
+    Loads a deferred configuration, alongside the study configuration it applies to
+    """
+    deferred = load_json(config_path)
+    for k in ["study_config", "deferred_metrics"]:
+        if k not in deferred.keys():
+            raise ValueError(f"Deferred configuration '{config_path}' does not contain a `{k}` entry!")
+
+    # The study configuration's path is relative to the deferred configuration's
+    study_json = load_json(config_path.parent / deferred["study_config"])
+    unknown = set(deferred["deferred_metrics"]["test"]) - set(study_json["metrics"]["test"])
+    if len(unknown) > 0:
+        raise ValueError(f"Deferred metrics {sorted(unknown)} are not test metrics of the study configuration!")
+
+    return deferred, study_json
+
+
+def load_labelled_configs(config_files: list[Path]):
+    # Map each configuration's label to the file it was loaded from
+    return {load_json(f)["label"]: f for f in config_files}
+
+
+def select_optima(df: pd.DataFrame, optima_metric: str, objective: str):
+    """
+    Select the optimum trial of each replicate for the given metric, breaking ties with a second metric; the same
+    selection `get_values_at_other_optima` makes during results analysis.
+    """
+    tie_breaker = OPTIMA_TIE_BREAKERS.get(optima_metric, objective)
+    sorting_metrics = [optima_metric] if tie_breaker == optima_metric else [optima_metric, tie_breaker]
+    sorting_cols = [f"{m} (validate)" for m in sorting_metrics]
+    # Place the optima at the bottom, so they can be grabbed with `tail`
+    ascending = [m not in MINIMIZED_OBJECTIVES for m in sorting_metrics]
+    return df.sort_values(by=sorting_cols, ascending=ascending).groupby("replicate").tail(1)
+
+
+def seed_model(model_json: dict, seed: int):
+    """
+    Pin the `random_state` of a stochastic model, so that re-running a trial with the same parameters refits the same
+    model; configurations which specify their own are left as-is
+    """
+    seeded_json = deepcopy(model_json)
+    if model_json["model"] in SEEDED_MODELS:
+        seeded_json["parameters"].setdefault("random_state", seed)
+    elif model_json["model"] not in DETERMINISTIC_MODELS:
+        logging.warning(f"Model '{model_json['model']}' is not known to be deterministic, nor how to seed it; the "
+                        f"deferred metrics of its re-runs may describe a different model than the original trial's")
+    return seeded_json
+
+
+def pin_param(param: dict, value):
+    # Parameters the trial did not use (i.e. conditional ones) are recorded as null
+    is_null = value is None or (isinstance(value, float) and np.isnan(value))
+
+    # Cast the value recorded in the database back to the type the parameter expects
+    if param["type"] in ("int", "float"):
+        if is_null:
+            return UNSET
+        return int(value) if param["type"] == "int" else float(value)
+    elif param["type"] == "categorical":
+        for c in param["choices"]:
+            if (c is None and is_null) or (not is_null and str(c) == str(value)):
+                return c
+        if is_null:
+            return UNSET
+        raise ValueError(f"Value '{value}' is not a valid choice for parameter '{param['label']}'")
+    raise ValueError(f"Unknown parameter type '{param['type']}' for parameter '{param['label']}'")
+
+
+def pin_tunable_params(config, trial_row: pd.Series):
+    """
+    Recursively replace every tunable parameter in a configuration with the value the trial used for it, dropping
+    those the trial did not use at all
+    """
+    if isinstance(config, dict):
+        if "label" in config.keys() and "type" in config.keys():
+            if config["label"] not in trial_row.index:
+                raise ValueError(f"Parameter '{config['label']}' was not tracked; was the study run with "
+                                 f"`track_params` enabled?")
+            return pin_param(config, trial_row[config["label"]])
+        pinned = {k: pin_tunable_params(v, trial_row) for k, v in config.items()}
+        return {k: v for k, v in pinned.items() if v is not UNSET}
+    elif isinstance(config, list):
+        return [pin_tunable_params(v, trial_row) for v in config]
+    return config
+
+
+def build_cheap_study(study_json: dict, deferred: dict, output_folder: Path):
+    """
+    Derive the study configuration to run for all combinations; the original, without the deferred metrics
+    """
+    cheap_json = deepcopy(study_json)
+    deferred_metrics = deferred["deferred_metrics"]["test"]
+    cheap_json["metrics"]["test"] = [m for m in study_json["metrics"]["test"] if m not in deferred_metrics]
+
+    # The parameters of each trial are needed to re-run the optima later
+    cheap_json["track_params"] = True
+    cheap_json["output_path"] = str((output_folder / "results.db").resolve())
+
+    return cheap_json
+
+
+def build_rerun_study(study_json: dict, deferred: dict, n_replicates: int, output_folder: Path):
+    """
+    Derive the study configuration re-running an optimum trial found in replicate `n_replicates - 1`
+    """
+    rerun_json = deepcopy(study_json)
+
+    # Every parameter is pinned, so one trial reproduces the optimum; the replicates before the optimum's own are
+    # only run to reach its split
+    rerun_json["no_replicates"] = n_replicates
+    rerun_json["no_trials"] = 1
+    # The trial keeps its own cheap test metrics; the objective is only re-calculated as a check
+    rerun_json["metrics"] = {"validate": [study_json["objective"]], "test": deferred["deferred_metrics"]["test"]}
+    rerun_json["track_params"] = False
+    rerun_json["label"] = f"{study_json['label']}_rerun"
+    rerun_json["output_path"] = str((output_folder / "rerun_results.db").resolve())
+
+    return rerun_json
+
+
+def write_study(study_json: dict, deferred: dict, model_folder: Path, data_folder: list[Path], output_folder: Path):
+    if len(data_folder) < 1:
+        raise ValueError("At least one data folder must be provided to prepare the study jobs!")
+    data_files = sorted(f for d in data_folder for f in d.glob('*.json'))
+
+    seeded_folder = output_folder / "model_configs"
+    if not seeded_folder.exists():
+        seeded_folder.mkdir(parents=True)
+
+    # Seed each of the models, so their optima can be rebuilt exactly when re-run
+    model_files = []
+    for f in sorted(model_folder.glob('*.json')):
+        model_files.append(seeded_folder / f.name)
+        save_json(seed_model(load_json(f), study_json["random_seed"]), model_files[-1])
+
+    study_file = output_folder / "study.json"
+    save_json(build_cheap_study(study_json, deferred, output_folder), study_file)
+
+    jobs_df = build_job_list(data_files, model_files).assign(study_config=str(study_file.resolve()))
+    save_job_list(jobs_df, output_folder / "jobs.tsv")
+
+
+def prepare(study_json: dict, deferred: dict, results_db: Path, data_folder: list[Path], optima: list[str],
+            output_folder: Path):
+    if len(data_folder) < 1:
+        raise ValueError("At least one data folder must be provided to prepare the re-run jobs!")
+    # The re-runs must use the same (seeded) model configurations as the study did
+    seeded_folder = output_folder / "model_configs"
+    if not seeded_folder.exists():
+        raise ValueError(f"No seeded model configurations were found in '{seeded_folder}'; was the study prepared "
+                         f"with the `study` mode first?")
+    model_files = load_labelled_configs(sorted(seeded_folder.glob('*.json')))
+    data_files = load_labelled_configs(sorted(f for d in data_folder for f in d.glob('*.json')))
+
+    config_folder = output_folder / "configs"
+    if not config_folder.exists():
+        config_folder.mkdir(parents=True)
+
+    # Select the optimum trials of every replicate, for every combination in the study
+    optima_dfs = {}
+    n_jobs = 0
+    for table, df in read_results_tables(results_db).items():
+        if table.split('__')[0] != study_json["label"]:
+            continue
+        # The same trial can be the optimum for multiple metrics; only evaluate it once
+        table_optima = pd.concat([select_optima(df, m, study_json["objective"]) for m in optima]).drop_duplicates()
+        table_optima["job"] = np.arange(n_jobs, n_jobs + table_optima.shape[0])
+        n_jobs += table_optima.shape[0]
+        optima_dfs[table] = table_optima
+
+    # Generate pinned configurations for each optimum trial
+    job_rows = []
+    rerun_study_files = {}
+    for table, table_optima in optima_dfs.items():
+        _, model_label, data_label = table.split('__')
+        for _, trial_row in table_optima.iterrows():
+            job = int(trial_row["job"])
+            model_json = pin_tunable_params(load_json(model_files[model_label]), trial_row)
+            data_json = pin_tunable_params(load_json(data_files[data_label]), trial_row)
+            # Each job needs a unique label, so their results tables do not overwrite one another
+            data_json["label"] = f"{data_json['label']}_job{job}"
+
+            model_file = config_folder / f"job{job}_model.json"
+            data_file = config_folder / f"job{job}_data.json"
+            save_json(model_json, model_file)
+            save_json(data_json, data_file)
+
+            # Optima from the same replicate share a re-run study configuration
+            n_replicates = int(trial_row["replicate"]) + 1
+            if n_replicates not in rerun_study_files.keys():
+                rerun_study_files[n_replicates] = config_folder / f"rerun_study_r{n_replicates}.json"
+                save_json(build_rerun_study(study_json, deferred, n_replicates, output_folder),
+                          rerun_study_files[n_replicates])
+
+            rerun_table = f"{study_json['label']}_rerun__{model_json['label']}__{data_json['label']}"
+            job_rows.append([str(data_file.resolve()), str(model_file.resolve()),
+                             str(rerun_study_files[n_replicates].resolve()), rerun_table])
+
+    # Save the optimum rows themselves, so they can be merged with their re-run's metrics later
+    db_con = connect(output_folder / "selected.db")
+    for table, table_optima in optima_dfs.items():
+        table_optima.to_sql(table, con=db_con, if_exists='replace', index=False)
+    db_con.close()
+
+    jobs_df = pd.DataFrame(job_rows, columns=JOB_COLS + RERUN_COLS)
+    save_job_list(jobs_df, output_folder / "rerun_jobs.tsv", RERUN_COLS)
+
+
+def merge(study_json: dict, output_folder: Path):
+    jobs_df = pd.read_csv(output_folder / "rerun_jobs.tsv", sep='\t')
+    selected_dfs = read_results_tables(output_folder / "selected.db")
+    rerun_dfs = read_results_tables(output_folder / "rerun_results.db")
+    objective_col = f"{study_json['objective']} (validate)"
+
+    # Save the result in the same format as the study's results, one table per combination
+    db_con = connect(output_folder / "optima.db")
+    n_merged, n_differed = 0, 0
+    for table, selected_df in selected_dfs.items():
+        merged_rows = []
+        for _, trial_row in selected_df.iterrows():
+            job = int(trial_row["job"])
+            rerun_table = jobs_df.loc[job, "rerun_table"]
+            rerun_df = rerun_dfs.get(rerun_table)
+            if rerun_df is None or (rerun_df["replicate"] == trial_row["replicate"]).sum() < 1:
+                logging.warning(f"No re-run results for job {job} ('{table}'), skipping it")
+                continue
+            # Only the last replicate of the re-run is the optimum's own
+            rerun_row = rerun_df.loc[rerun_df["replicate"] == trial_row["replicate"]].iloc[0]
+
+            # The trial keeps its own (cheap) test metrics; the re-run only adds the deferred ones
+            deferred_cols = [c for c in rerun_row.index if c.endswith(" (test)")]
+            merged_row = pd.concat([trial_row, rerun_row[deferred_cols]])
+            merged_row["rerun_objective_delta"] = rerun_row[objective_col] - trial_row[objective_col]
+            merged_rows.append(merged_row)
+
+            if not np.isclose(rerun_row[objective_col], trial_row[objective_col]):
+                n_differed += 1
+        if len(merged_rows) < 1:
+            continue
+        pd.DataFrame(merged_rows).drop(columns=["job"]).to_sql(table, con=db_con, if_exists='replace', index=False)
+        n_merged += len(merged_rows)
+    db_con.close()
+
+    print(f"Merged the deferred metrics of {n_merged} optimum trials into '{output_folder / 'optima.db'}'")
+    if n_differed > 0:
+        logging.warning(f"{n_differed} re-runs did not reproduce their trial's validation objective, so their split or "
+                        f"model differed from the trial's; see the `rerun_objective_delta` column. Their deferred "
+                        f"metrics may not describe the selected trial's model.")
+
+
+def main(mode: str, deferred_config: Path, results_db: Path, model_folder: Path, data_folder: list[Path],
+         optima: list[str], output_folder: Path):
+    deferred, study_json = load_deferred_config(deferred_config)
+
+    output_folder = output_folder / study_json["label"]
+    if mode == 'study':
+        write_study(study_json, deferred, model_folder, data_folder, output_folder)
+    elif mode == 'prepare':
+        if results_db is None:
+            results_db = output_folder / "results.db"
+        if optima is None:
+            optima = [study_json["objective"]]
+        prepare(study_json, deferred, results_db, data_folder, optima, output_folder)
+    else:
+        merge(study_json, output_folder)
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    argvs = parser.parse_args().__dict__
+
+    main(**argvs)
@@ -0,0 +1,216 @@
+"""
+Multi-fidelity ("successive halving") screening of dataset x model combinations.
+
+Rather than giving every combination the full budget of the study, each combination is first run with a small budget
+(few replicates and trials); only the best fraction of them (ranked on the study's validation objective) are promoted
+to the next rung, with those surviving the final rung being promoted to the full study. The rungs, and the fraction
+promoted at each, are specified in a screening configuration (see `screening_config/`), which points to the study
+configuration being screened for; MOOP never reads it, so the study configuration itself remains unchanged.
+
+Each call of this script prepares a single rung, writing a job list (one dataset, model, and study configuration per
+line) which can be run with `run_job_list.sl`. Rung 0 contains every combination; rung `r > 0` contains the
+combinations promoted from the results of rung `r - 1`. Requesting the rung after the last one writes the job list
+(and a copy of the study configuration) for the full study instead.
+"""
+import logging
+from argparse import ArgumentParser
+from copy import deepcopy
+from math import ceil
+from pathlib import Path
+from sqlite3 import connect
+
+import pandas as pd
+
+from study_utils import MINIMIZED_OBJECTIVES, build_job_list, load_json, save_job_list, save_json
+
+
+# The largest fraction of a rung's jobs which may be missing results before the rung is considered unfinished
+MAX_MISSING_FRACTION = 0.05
+
+# Extra columns of the job list files, identifying the combination each job runs
+LABEL_COLS = ["data_label", "model_label"]
+
+
+def get_parser():
+    argparser = ArgumentParser(
+        prog="Combination Screening",
+        description="Prepares one rung of a successive-halving screen over all dataset and model configurations."
+    )
+
+    argparser.add_argument(
+        '-c', '--screening_config', required=True, type=Path,
+        help="The screening configuration, specifying the study configuration to screen for and the rungs to run."
+    )
+    argparser.add_argument(
+        '-m', '--model_folder', default='./model_configs', type=Path,
+        help="Folder containing the model configurations to screen."
+    )
+    argparser.add_argument(
+        '-d', '--data_folder', required=True, type=Path, nargs='+',
+        help="Folder(s) containing the dataset configurations to screen; all combinations within are ranked together."
+    )
+    argparser.add_argument(
+        '-r', '--rung', required=True, type=int,
+        help="The rung to prepare. Rung 0 screens all combinations; any later rung promotes the best combinations "
+             "from the rung before it. The rung after the last one produces the job list for the full study."
+    )
+    argparser.add_argument(
+        '--max_missing', default=MAX_MISSING_FRACTION, type=float,
+        help="The largest fraction of the prior rung's jobs which may be missing results (i.e. because they failed) "
+             "when promoting from it; if more are missing, the rung is assumed to be unfinished, and nothing is "
+             "promoted."
+    )
+    argparser.add_argument(
+        '-o', '--output_folder', default='./screening', type=Path,
+        help="Folder where the screening configurations, job lists, and results are placed within."
+    )
+
+    return argparser
+
+
+def load_screening_config(config_path: Path):
+    """
+    Loads a screening configuration, alongside the study configuration it screens for
+    """
+    screening = load_json(config_path)
+    for k in ["study_config", "rungs"]:
+        if k not in screening.keys():
+            raise ValueError(f"Screening configuration '{config_path}' does not contain a `{k}` entry!")
+
+    # The study configuration's path is relative to the screening configuration's
+    study_config = config_path.parent / screening["study_config"]
+    return screening, load_json(study_config)
+
+
+def build_rung_study(study_json: dict, screening: dict, rung_idx: int, rung_folder: Path):
+    """
+    Derive the (reduced budget) study configuration for a screening rung from the full study configuration
+    """
+    rung_json = deepcopy(study_json)
+    rung = screening["rungs"][rung_idx]
+
+    # Replace the budget of the study with the (reduced) budget of the rung
+    for k in ["no_replicates", "no_crosses", "no_trials"]:
+        if k in rung.keys():
+            rung_json[k] = rung[k]
+
+    # Only the objective is used for ranking, so skip any (potentially expensive) test metrics
+    objective = rung_json["objective"]
+    rung_json["metrics"]["test"] = [objective]
+    if objective not in rung_json["metrics"]["validate"]:
+        rung_json["metrics"]["validate"].append(objective)
+
+    # Keep each rung's results separate from one another (and from the full study)
+    rung_json["label"] = f"{study_json['label']}_rung{rung_idx}"
+    rung_json["output_path"] = str((rung_folder / "results.db").resolve())
+
+    return rung_json
+
+
+def score_combinations(jobs_df: pd.DataFrame, study_label: str, objective: str, db_path: Path, max_missing: float):
+    """
+    Score each combination by the mean (across replicates) of the best validation objective found within each
+    replicate; mirrors how the optima are selected during results analysis.
+    """
+    # Connecting would otherwise create an empty database, silently pruning every combination
+    if not db_path.exists():
+        raise ValueError(f"No results database was found at '{db_path}'; has the prior rung been run?")
+
+    minimize = objective in MINIMIZED_OBJECTIVES
+    objective_col = f"{objective} (validate)"
+
+    db_con = connect(db_path)
+    scores = []
+    for _, job in jobs_df.iterrows():
+        table = f"{study_label}__{job['model_label']}__{job['data_label']}"
+        try:
+            result_df = pd.read_sql(f'SELECT replicate, "{objective_col}" FROM "{table}"', con=db_con)
+        # Jobs which failed (or are yet to finish) leave no usable table behind; they cannot be promoted
+        except Exception:
+            scores.append(None)
+            continue
+
+        replicate_optima = result_df.groupby("replicate")[objective_col]
+        replicate_optima = replicate_optima.min() if minimize else replicate_optima.max()
+        scores.append(replicate_optima.mean())
+    db_con.close()
+
+    scored_df = jobs_df.copy()
+    scored_df["score"] = scores
+    scored_df["table"] = [f"{study_label}__{m}__{d}" for m, d in zip(jobs_df["model_label"], jobs_df["data_label"])]
+
+    # Too many missing results means the rung has not finished (or the wrong one was read); pruning the combinations
+    # which are missing would be permanent, so don't promote anything until this is resolved
+    missing = scored_df.loc[scored_df["score"].isna(), "table"].tolist()
+    if len(missing) == len(scored_df) or len(missing) > max_missing * len(scored_df):
+        raise ValueError(f"{len(missing)} of {len(scored_df)} jobs have no results in '{db_path}', including "
+                         f"{missing[:5]}; finish (or re-run) them before promoting, or raise `--max_missing` if they "
+                         f"failed for good")
+    for t in missing:
+        logging.warning(f"No results for '{t}', it will not be promoted")
+    scored_df = scored_df.drop(columns=["table"]).dropna(subset=["score"])
+
+    # Place the best combinations first
+    return scored_df.sort_values("score", ascending=minimize)
+
+
+def promote(scored_df: pd.DataFrame, promote_fraction: float, min_promoted: int):
+    n_promoted = max(ceil(promote_fraction * scored_df.shape[0]), min_promoted)
+    return scored_df.head(n_promoted)
+
+
+def main(screening_config: Path, model_folder: Path, data_folder: list[Path], rung: int, max_missing: float,
+         output_folder: Path):
+    screening, study_json = load_screening_config(screening_config)
+    n_rungs = len(screening["rungs"])
+    if rung < 0 or rung > n_rungs:
+        raise ValueError(f"Rung must be between 0 and {n_rungs} (the full study), got {rung}")
+
+    study_folder = output_folder / study_json["label"]
+
+    if rung == 0:
+        # Screen every combination of the configurations provided
+        data_files = sorted(f for d in data_folder for f in d.glob('*.json'))
+        model_files = sorted(model_folder.glob('*.json'))
+        # The rung's study configuration is assigned to the jobs below
+        jobs_df = build_job_list(data_files, model_files)
+    else:
+        # Rank the combinations run in the prior rung, and keep only the best of them
+        prior_folder = study_folder / f"rung_{rung - 1}"
+        prior_jobs_df = pd.read_csv(prior_folder / "jobs.tsv", sep='\t')
+        prior_label = f"{study_json['label']}_rung{rung - 1}"
+        scored_df = score_combinations(
+            prior_jobs_df, prior_label, study_json["objective"], prior_folder / "results.db", max_missing
+        )
+        scored_df.to_csv(prior_folder / "ranking.tsv", sep='\t', index=False)
+
+        prior_rung = screening["rungs"][rung - 1]
+        jobs_df = promote(scored_df, prior_rung["promote_fraction"], screening.get("min_promoted", 1))
+        print(f"Promoted {jobs_df.shape[0]} of {prior_jobs_df.shape[0]} combinations from rung {rung - 1}")
+
+    # The rung after the final one is the full study, which runs with (a copy of) the original study configuration;
+    # copying it keeps the full study's jobs consistent with the screen, even if the original is edited in the interim
+    if rung == n_rungs:
+        job_folder, job_file = study_folder, study_folder / "full_jobs.tsv"
+        job_study_file, job_study = study_folder / "full_study.json", study_json
+    # Otherwise, generate the reduced study configuration for this rung
+    else:
+        rung_folder = study_folder / f"rung_{rung}"
+        job_folder, job_file = rung_folder, rung_folder / "jobs.tsv"
+        job_study_file = rung_folder / "study.json"
+        job_study = build_rung_study(study_json, screening, rung, rung_folder)
+
+    if not job_folder.exists():
+        job_folder.mkdir(parents=True)
+    save_json(job_study, job_study_file)
+
+    # Point all the jobs to the study configuration
+    jobs_df = jobs_df.assign(study_config=str(job_study_file.resolve()))
+    save_job_list(jobs_df, job_file, LABEL_COLS)
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    argvs = parser.parse_args().__dict__
+
+    main(**argvs)
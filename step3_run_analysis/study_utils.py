@@ -0,0 +1,79 @@
+"""
+Helpers shared by the tools which generate (and analyse) study jobs outside the `.sl` scripts; namely
+`screen_combinations.py` and `deferred_metrics.py`.
+"""
+import json
+import logging
+from math import ceil
+from pathlib import Path
+from sqlite3 import connect
+
+import pandas as pd
+
+
+JSON_INDENT = 2
+
+# Objectives which are "better" when lower; everything else is assumed to be maximized
+MINIMIZED_OBJECTIVES = {"log_loss"}
+
+# The largest array a job list is dispatched as; matches the array size of the other `.sl` scripts, and falls
+# comfortably within the default `MaxArraySize` of most clusters. Larger job lists run several jobs per array task
+MAX_ARRAY_TASKS = 600
+
+# Columns every job list starts with, in the order `run_job_list.sl` expects them
+JOB_COLS = ["data_config", "model_config", "study_config"]
+
+
+def load_json(json_path: Path):
+    with open(json_path, 'r') as fp:
+        return json.load(fp)
+
+
+def save_json(json_data: dict, json_path: Path):
+    with open(json_path, 'w') as fp:
+        json.dump(json_data, fp, indent=JSON_INDENT)
+
+
+def read_results_tables(db_path: Path):
+    # Read every results table in the database; one per study, model, and dataset combination
+    db_con = connect(db_path)
+    tables = [x[0] for x in db_con.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()]
+    result_dfs = {}
+    for t in tables:
+        try:
+            result_dfs[t] = pd.read_sql(f'SELECT * FROM "{t}"', con=db_con)
+        # Tables may be corrupted if they were being written to when a job was terminated
+        except Exception:
+            logging.warning(f"Failed to read table '{t}', ignoring it")
+    db_con.close()
+    return result_dfs
+
+
+def build_job_list(data_files: list[Path], model_files: list[Path]):
+    # Every combination of the data and model configurations provided; the study configuration is assigned later
+    job_rows = []
+    for d in data_files:
+        data_label = load_json(d)["label"]
+        for m in model_files:
+            model_label = load_json(m)["label"]
+            job_rows.append([str(d.resolve()), str(m.resolve()), None, data_label, model_label])
+
+    return pd.DataFrame(job_rows, columns=JOB_COLS + ["data_label", "model_label"])
+
+
+def save_job_list(jobs_df: pd.DataFrame, job_file: Path, extra_cols: list[str] = ()):
+    """
+    Save a job list, and print the command to run it with `run_job_list.sl`
+    """
+    if jobs_df.shape[0] < 1:
+        raise ValueError(f"No jobs to write to '{job_file}'!")
+    jobs_df.loc[:, JOB_COLS + list(extra_cols)].to_csv(job_file, sep='\t', index=False)
+
+    # Group the jobs into as few array tasks as needed to stay within the maximum array size
+    jobs_per_task = ceil(jobs_df.shape[0] / MAX_ARRAY_TASKS)
+    n_tasks = ceil(jobs_df.shape[0] / jobs_per_task)
+
+    # Let the user know how to dispatch the jobs
+    print(f"Wrote {jobs_df.shape[0]} jobs to '{job_file}' ({jobs_per_task} per array task); run them with:")
+    print(f"  sbatch --array=0-{n_tasks - 1} --export=ALL,JOB_LIST={job_file.resolve()},JOBS_PER_TASK={jobs_per_task} "
+          f"run_job_list.sl")